@@ -0,0 +1,101 @@
+import time
+import heapq
+import asyncio
+import itertools
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+# Приоритеты запросов к модели: меньше — важнее
+PRIORITY_CHAT = 0
+PRIORITY_INLINE = 1
+PRIORITY_BACKGROUND = 2
+
+# Очередь к модели переполнена
+class Overloaded(Exception):
+    pass
+
+# Пользователь исчерпал свой лимит запросов
+class RateLimited(Exception):
+    pass
+
+# Token bucket на каждого пользователя: rate запросов в секунду, не больше burst подряд.
+# Хранится не больше max_keys корзин, давно не использованные выбрасываются (то есть снова полны)
+class TokenBuckets:
+    def __init__(self, rate: float, burst: int, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def allow(self, key) -> bool:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return allowed
+
+# Ограничение одновременных запросов с приоритетной очередью ограниченной длины.
+# Освободившийся слот достаётся самому приоритетному из ожидающих, при полной очереди — Overloaded
+class PriorityLimiter:
+    def __init__(self, capacity: int, max_queue: int):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int = PRIORITY_CHAT):
+        if self.active < self.capacity and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise Overloaded()
+
+        future = asyncio.get_running_loop().create_future()
+        item = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, item)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже передан нам — возвращаем его следующему
+                self.release()
+            elif item in self._waiters:
+                self._waiters.remove(item)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_CHAT):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+# Значение заголовка Retry-After в секундах, если он есть и задан числом
+def retry_after(error) -> float:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,216 @@
+# Нагрузочный тест бота без сети: Application из bot.py работает против локальных заглушек
+# OpenRouter и Telegram Bot API, а синтетические обновления из fixture-файла подаются
+# в process_update так же, как их доставил бы вебхук.
+#
+#   python -m bench.loadtest --users 50
+#   python -m bench.loadtest --users 200 --kinds inline --error-rate 0.2
+#
+# Отчёт по каждой фазе (direct, group, inline): пропускная способность, задержка
+# p50/p95/p99 до завершения обработки и до первого видимого текста, число запросов
+# к модели на одно сообщение пользователя и рост памяти процесса.
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+import tornado.httpserver
+import tornado.netutil
+
+from bench import mock_openrouter, mock_telegram
+
+KINDS = ("direct", "group", "inline")
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+def serve(app) -> int:
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    return sockets[0].getsockname()[1]
+
+def load_fixture(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class Replay:
+    def __init__(self, app, stub, args):
+        self.app = app
+        self.stub = stub
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.updates = 0
+        self.latencies = []
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _message(self, chat: dict, user_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids), "date": int(time.time()),
+                "chat": chat, "from": self._user(user_id), "text": text,
+            },
+        }
+
+    async def _process(self, data: dict, chat_id: int = None, measure: bool = False):
+        from telegram import Update
+
+        update = Update.de_json(data, self.app.bot)
+        self.updates += 1
+        if chat_id is not None:
+            self.stub.expect(chat_id)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        if measure:
+            self.latencies.append(time.perf_counter() - started)
+
+    async def direct(self, user_id: int, line: dict):
+        chat = {"id": user_id, "type": "private"}
+        await self._process(self._message(chat, user_id, line["text"]), user_id, measure=True)
+
+    async def group(self, user_id: int, line: dict):
+        # У каждого пользователя своя группа, чтобы время первого ответа относилось к его сообщению
+        chat = {"id": -1000 - user_id, "type": "supergroup", "title": f"Group{user_id}"}
+        addressed = line.get("addressed", False)
+        text = line["text"]
+        if addressed and line.get("mention", True):
+            text = f"@{mock_telegram.BOT_USER['username']} {text}"
+        await self._process(self._message(chat, user_id, text), chat["id"] if addressed else None, measure=addressed)
+
+    async def inline(self, user_id: int, line: dict):
+        # Набор запроса по буквам: Telegram присылает обновление почти на каждое нажатие
+        text = line["text"]
+        tasks = []
+        for i in range(1, len(text) + 1):
+            data = {
+                "update_id": next(self.update_ids),
+                "inline_query": {"id": str(next(self.update_ids)), "from": self._user(user_id),
+                                 "query": text[:i], "offset": ""},
+            }
+            tasks.append(asyncio.create_task(self._process(data, measure=i == len(text))))
+            await asyncio.sleep(self.args.keystroke_interval * random.uniform(0.5, 1.5))
+        await asyncio.gather(*tasks)
+
+    async def user_session(self, user_id: int, lines: list):
+        await asyncio.sleep(random.uniform(0, self.args.ramp_up))
+        for line in lines:
+            await getattr(self, line["kind"])(user_id, line)
+            await asyncio.sleep(self.args.think_time * random.uniform(0.5, 1.5))
+
+async def run(args):
+    mock_config = mock_openrouter.MockConfig(
+        args.ttft, args.token_delay, args.reply_tokens, args.error_rate, args.retry_after, args.overloaded_model
+    )
+    openrouter_port = serve(mock_openrouter.make_app(mock_config))
+    stub = mock_telegram.TelegramStub()
+    telegram_port = serve(mock_telegram.make_app(stub))
+
+    # Настройки бота читаются при импорте, поэтому окружение задаётся до него
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:BENCH",
+        "OPENROUTER_API_KEY": "bench",
+        "OPENROUTER_BASE_URL": f"http://127.0.0.1:{openrouter_port}/v1",
+        "HISTORY_DB": os.path.join(tempfile.mkdtemp(prefix="ablgpt-bench-"), "history.db"),
+        "STREAM_REPLIES": "0" if args.no_stream else "1",
+        "METRICS_PORT": "0",
+    })
+    import bot
+
+    stub.shed_texts = {bot.BUSY_REPLY, bot.SLOW_DOWN_REPLY}
+    app = bot.build_application(base_url=f"http://127.0.0.1:{telegram_port}/bot")
+    await app.initialize()
+    await bot.on_startup(app)
+
+    fixture = load_fixture(args.fixture)
+    rss_start = rss_mb()
+    report = {}
+    for kind in args.kinds:
+        lines = [line for line in fixture if line["kind"] == kind]
+        if not lines:
+            continue
+        replay = Replay(app, stub, args)
+        calls_before = mock_config.calls
+        stub.first_text.clear()
+        rss_before = rss_mb()
+        started = time.perf_counter()
+        await asyncio.gather(*(replay.user_session(user_id, lines) for user_id in range(1, args.users + 1)))
+        elapsed = time.perf_counter() - started
+
+        messages = len(replay.latencies)
+        calls = mock_config.calls - calls_before
+        first_text = list(stub.first_text)
+        report[kind] = {
+            "updates": replay.updates,
+            "user_messages": messages,
+            "seconds": round(elapsed, 2),
+            "updates_per_sec": round(replay.updates / elapsed, 1),
+            "messages_per_sec": round(messages / elapsed, 1),
+            "latency_ms": {f"p{p}": round(percentile(replay.latencies, p / 100) * 1000) for p in (50, 95, 99)},
+            "first_text_ms": {f"p{p}": round(percentile(first_text, p / 100) * 1000) for p in (50, 95, 99)}
+            if first_text else None,
+            "upstream_calls": calls,
+            "upstream_calls_per_message": round(calls / messages, 2) if messages else None,
+            "rss_growth_mb": round(rss_mb() - rss_before, 1),
+        }
+
+    await app.shutdown()
+    await bot.on_shutdown(app)
+
+    report["total"] = {
+        "upstream_calls": mock_config.calls,
+        "upstream_rejected_429": mock_config.rejected,
+        "shed_replies": stub.shed,
+        "telegram_calls": stub.calls,
+        "rss_start_mb": round(rss_start, 1),
+        "rss_growth_mb": round(rss_mb() - rss_start, 1),
+        "history_hot_users": len(bot.history),
+    }
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест AblGpt против локальных заглушек")
+    parser.add_argument("--fixture", default=os.path.join(os.path.dirname(__file__), "fixtures", "mixed.jsonl"))
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=list(KINDS))
+    parser.add_argument("--ramp-up", type=float, default=1.0, help="разброс старта пользователей, с")
+    parser.add_argument("--think-time", type=float, default=1.0, help="пауза между сообщениями пользователя, с")
+    parser.add_argument("--keystroke-interval", type=float, default=0.15)
+    parser.add_argument("--no-stream", action="store_true", help="отключить потоковые ответы")
+    parser.add_argument("--ttft", type=float, default=0.3, help="задержка заглушки до первого токена, с")
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429 от заглушки")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--overloaded-model", action="append", default=[])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести отчёт одной строкой JSON")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # Ответы 429 от заглушки ожидаемы, журнал доступа tornado их не печатает
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+import tornado.web
+
+# Локальная замена OpenRouter: OpenAI-совместимый /v1/chat/completions с настраиваемой
+# задержкой, потоковой выдачей и ответами 429. Отвечает эхом последней реплики пользователя
+class MockConfig:
+    def __init__(self, ttft: float = 0.3, token_delay: float = 0.02, reply_tokens: int = 60,
+                 error_rate: float = 0.0, retry_after: float = 1.0, overloaded_models=()):
+        self.ttft = ttft
+        self.token_delay = token_delay
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.overloaded_models = set(overloaded_models)
+        self.calls = 0
+        self.rejected = 0
+        self.streamed = 0
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "rejected": self.rejected, "streamed": self.streamed}
+
+class ChatCompletionsHandler(tornado.web.RequestHandler):
+    def initialize(self, config: MockConfig):
+        self.config = config
+
+    async def post(self):
+        config = self.config
+        body = json.loads(self.request.body)
+        config.calls += 1
+
+        if body["model"] in config.overloaded_models or random.random() < config.error_rate:
+            config.rejected += 1
+            self.set_status(429)
+            self.set_header("Retry-After", str(config.retry_after))
+            self.write({"error": {"message": "Rate limit exceeded", "code": 429}})
+            return
+
+        prompt = body["messages"][-1]["content"]
+        usage = {"prompt_tokens": len(json.dumps(body["messages"])) // 3, "completion_tokens": 0, "total_tokens": 0}
+        words = (f"Ответ на «{prompt[:50]}»: " + "слово " * config.reply_tokens).split()
+        words = words[:min(len(words), body.get("max_tokens") or len(words))]
+        await asyncio.sleep(config.ttft)
+
+        if not body.get("stream"):
+            await asyncio.sleep(config.token_delay * len(words))
+            usage["completion_tokens"] = len(words)
+            self.write({
+                "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        config.streamed += 1
+        self.set_header("Content-Type", "text/event-stream")
+        for i, word in enumerate(words):
+            chunk = {
+                "id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+            }
+            self.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+            await self.flush()
+            await asyncio.sleep(config.token_delay)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            usage["completion_tokens"] = len(words)
+            chunk = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body["model"], "choices": [], "usage": usage}
+            self.write(f"data: {json.dumps(chunk)}\n\n")
+        self.write("data: [DONE]\n\n")
+
+def make_app(config: MockConfig) -> tornado.web.Application:
+    return tornado.web.Application([(r"/v1/chat/completions", ChatCompletionsHandler, {"config": config})])
+
+async def serve(port: int, config: MockConfig):
+    make_app(config).listen(port, address="127.0.0.1")
+    print(f"Mock OpenRouter: http://127.0.0.1:{port}/v1")
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная замена OpenRouter для нагрузочных тестов")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--ttft", type=float, default=0.3, help="задержка до первого токена, с")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="задержка между токенами, с")
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--overloaded-model", action="append", default=[], help="модель, всегда отвечающая 429")
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, MockConfig(
+        args.ttft, args.token_delay, args.reply_tokens, args.error_rate, args.retry_after, args.overloaded_model
+    )))
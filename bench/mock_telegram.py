@@ -0,0 +1,60 @@
+import json
+import time
+import itertools
+import tornado.web
+
+BOT_USER = {"id": 42, "is_bot": True, "first_name": "AblGpt", "username": "AblGptBot"}
+
+# Заглушка Telegram Bot API: принимает исходящие вызовы бота и считает их.
+# Для чатов, отмеченных через expect(), запоминает время до первого видимого текста;
+# отдельно считает ответы из shed_texts (отказы под нагрузкой)
+class TelegramStub:
+    def __init__(self, shed_texts=()):
+        self.calls = {}
+        self.first_text = []
+        self.shed_texts = set(shed_texts)
+        self.shed = 0
+        self._expected = {}
+        self._message_ids = itertools.count(1)
+
+    def expect(self, chat_id: int):
+        self._expected[chat_id] = time.perf_counter()
+
+    def record(self, method: str, params: dict):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "sendMessage" and params.get("text") in self.shed_texts:
+            self.shed += 1
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            started = self._expected.pop(chat_id, None)
+            if started is not None:
+                self.first_text.append(time.perf_counter() - started)
+
+    def message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+class BotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, stub: TelegramStub):
+        self.stub = stub
+
+    def post(self, token: str, method: str):
+        params = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+        self.stub.record(method, params)
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            result = self.stub.message(params)
+        else:
+            result = True
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"ok": True, "result": result}))
+
+def make_app(stub: TelegramStub) -> tornado.web.Application:
+    return tornado.web.Application([(r"/bot([^/]+)/(\w+)", BotApiHandler, {"stub": stub})])
@@ -1,33 +1,172 @@
 import os
+import re
+import time
+import random
 import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from uuid import uuid4
-from openai import OpenAI
+import httpx
+from openai import (
+    AsyncOpenAI, DefaultAsyncHttpxClient, Timeout,
+    APIConnectionError, InternalServerError, RateLimitError
+)
 from telegram import Update, InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
     InlineQueryHandler, CallbackContext, filters
 )
-from telegram.constants import ChatAction
+from telegram.constants import ChatAction, ChatType, MessageLimit
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from cache import TTLCache, prompt_key
+from history import HistoryStore, SQLiteBackend
+import metrics
+from metrics import (
+    instrumented, trace, Superseded, TimedRequest, UPSTREAM_SECONDS, UPSTREAM_TTFT_SECONDS,
+    UPSTREAM_TOKENS, QUEUE_WAIT_SECONDS, USER_WAIT_SECONDS, REJECTED
+)
+from admission import (
+    PriorityLimiter, TokenBuckets, Overloaded, RateLimited, retry_after,
+    PRIORITY_CHAT, PRIORITY_INLINE, PRIORITY_BACKGROUND
+)
 
 # Загрузка .env
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 WEBHOOK_URL = f"https://ablgpt.onrender.com/{TELEGRAM_TOKEN}"
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+MODEL = os.getenv("OPENROUTER_MODEL", "mistralai/mistral-7b-instruct")
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", MODEL)
+
+# Запасные модели через запятую: пробуются по порядку, когда основная перегружена
+MODELS = [MODEL] + [m.strip() for m in os.getenv("OPENROUTER_FALLBACK_MODELS", "").split(",") if m.strip()]
+
+# Лимиты на одновременные запросы к модели, длину очереди к ним и пул соединений
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "100"))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "200"))
+HTTP_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_KEEPALIVE_CONNECTIONS", "20"))
+
+# Лимит на пользователя: USER_RATE запросов в секунду, не больше USER_BURST подряд
+USER_RATE = float(os.getenv("USER_RATE", "0.5"))
+USER_BURST = int(os.getenv("USER_BURST", "5"))
+
+# Повторы при 429/5xx/обрывах связи: экспоненциальная пауза со случайным разбросом.
+# Если сервер просит ждать дольше RETRY_MAX_DELAY, сразу сдаёмся
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "10"))
+
+# Метрики Prometheus на отдельном порту (/metrics), 0 — отключить. TRACE_LOG=0 выключает трассировку
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+TRACE_LOG = os.getenv("TRACE_LOG", "1") == "1"
+
+BUSY_REPLY = "Сейчас у меня слишком много запросов 😅 Попробуйте, пожалуйста, через минуту."
+SLOW_DOWN_REPLY = "Не так быстро 🙂 Подождите пару секунд и напишите снова."
+ERROR_REPLY = "Не получилось получить ответ 😔 Попробуйте, пожалуйста, ещё раз чуть позже."
+# Ответы вместо модели: запрос отклонён или не удался
+REFUSAL_REPLIES = {BUSY_REPLY, SLOW_DOWN_REPLY, ERROR_REPLY}
+
+# Потоковые ответы: первое сообщение сразу, дальше правки не чаще раза в STREAM_EDIT_INTERVAL секунд.
+# В группах Telegram пропускает около 20 сообщений в минуту, поэтому там правки реже
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_GROUP_EDIT_INTERVAL = float(os.getenv("STREAM_GROUP_EDIT_INTERVAL", "3.0"))
+STREAM_MIN_CHARS = 20
+TYPING_INTERVAL = 4
+
+# Inline-режим: ждём паузу в наборе, ответы кэшируем по нормализованному тексту запроса
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.7"))
+INLINE_CACHE_TTL = int(os.getenv("INLINE_CACHE_TTL", "300"))
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "1000"))
 
-# Подключение к OpenRouter
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
+# Кэш ответов на реплики без контекста (первое сообщение диалога). Включается явно
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+
+# Группы: модель вызывается только при упоминании бота, ответе на его сообщение или слове-триггере.
+# Остальные сообщения копятся в коротком буфере и показываются модели как контекст чата
+GROUP_TRIGGER_WORDS = [w.strip().lower() for w in os.getenv("GROUP_TRIGGER_WORDS", "ablgpt").split(",") if w.strip()]
+
+GROUP_CONTEXT_MESSAGES = int(os.getenv("GROUP_CONTEXT_MESSAGES", "10"))
+GROUP_CONTEXT_CHARS = 300
+GROUP_CONTEXT_CHATS = int(os.getenv("GROUP_CONTEXT_CHATS", "1000"))
+
+# История: сколько пользователей держать в памяти, когда выгружать по простою и куда сохранять.
+# Пустой HISTORY_DB отключает сохранение на диск
+HISTORY_DB = os.getenv("HISTORY_DB", "history.db")
+HISTORY_HOT_USERS = int(os.getenv("HISTORY_HOT_USERS", "1000"))
+HISTORY_IDLE_TTL = float(os.getenv("HISTORY_IDLE_TTL", "1800"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "2"))
+
+# Контекст диалога ограничен бюджетом токенов. Когда история его превышает, старые реплики
+# сворачиваются в краткое содержание; последние HISTORY_KEEP_TURNS реплик остаются как есть
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "4"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "200"))
+
+# Подключение к OpenRouter (асинхронный клиент с общим пулом соединений)
+client = AsyncOpenAI(
+    base_url=OPENROUTER_BASE_URL,
     api_key=OPENROUTER_API_KEY,
     default_headers={
         "HTTP-Referer": "https://ablgpt.onrender.com",
         "X-Title": "AblGpt"
-    }
+    },
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_REQUESTS,
+            max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=30,
+        ),
+    ),
+    timeout=Timeout(60, connect=5),
+    # Повторы делает complete(), с учётом запасных моделей
+    max_retries=0,
 )
 
+# Глобальное ограничение числа запросов, одновременно ушедших в OpenRouter, с приоритетной очередью
+llm_limiter = PriorityLimiter(MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS)
+
+# Лимиты запросов по пользователям
+user_buckets = TokenBuckets(USER_RATE, USER_BURST)
+
+# Очередь на пользователя: сообщения одного пользователя обрабатываются строго по порядку
+user_locks = {}
+
+@asynccontextmanager
+async def user_turn(user_id: int):
+    entry = user_locks.get(user_id)
+    if entry is None:
+        entry = user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        # Убираем замок, когда у пользователя не осталось ожидающих сообщений
+        if entry[1] == 0:
+            del user_locks[user_id]
+
 # Хранилище истории чатов
-user_chat_history = {}
+history = HistoryStore(
+    backend=SQLiteBackend(HISTORY_DB) if HISTORY_DB else None,
+    max_users=HISTORY_HOT_USERS,
+    idle_ttl=HISTORY_IDLE_TTL,
+    flush_interval=HISTORY_FLUSH_INTERVAL,
+)
+
+# Кэш ответов без контекста, кэш inline-ответов и текущие inline-запросы пользователей
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+inline_cache = TTLCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+inline_tasks = {}
+
+# Последние сообщения в группах, не адресованные боту: chat_id -> deque строк "Имя: текст"
+group_context = OrderedDict()
 
 # Системное сообщение
 SYSTEM_PROMPT = {
@@ -35,71 +174,443 @@ SYSTEM_PROMPT = {
     "content": "Ты AblGpt — умный и дружелюбный Telegram-бот. Всегда представляйся как AblGpt, если спрашивают имя."
 }
 
+# Системное сообщение для сворачивания старой части диалога
+SUMMARY_PROMPT = {
+    "role": "system",
+    "content": "Сожми диалог пользователя с ботом в краткое содержание (до 5 предложений). "
+               "Сохрани факты о пользователе, его просьбы и договорённости. Отвечай только содержанием."
+}
+
+# Фоновые задачи сворачивания истории, не больше одной на пользователя
+summary_tasks = {}
+
 # Обработка команды /start
+@instrumented("start")
 async def start(update: Update, context: CallbackContext):
     await update.message.reply_text("Привет! Я AblGpt. Чем могу помочь?")
 
-# Получение ответа от модели
-def get_gpt_response(user_id: int, user_message: str) -> str:
+# Ключевые слова для длинного ответа
+LONG_ANSWER_KEYWORDS = ["подробнее", "подробно", "объясни полностью", "детальнее", "расскажи всё"]
+
+def pick_max_tokens(user_message: str) -> int:
+    is_long = any(kw in user_message.lower() for kw in LONG_ANSWER_KEYWORDS)
+    return 1000 if is_long else 300
+
+# Один запрос к конкретной модели. Если передан on_delta, ответ запрашивается
+# потоком и on_delta получает накопленный текст
+async def _complete_once(messages: list, max_tokens: int, on_delta, model: str) -> str:
+    started = time.perf_counter()
+    first_token_at = None
+    usage = None
+    outcome = "error"
     try:
-        user_chat_history.setdefault(user_id, [SYSTEM_PROMPT.copy()])
-        user_chat_history[user_id].append({"role": "user", "content": user_message})
-
-        # Ключевые слова для длинного ответа
-        long_answer_keywords = ["подробнее", "подробно", "объясни полностью", "детальнее", "расскажи всё"]
-        is_long = any(kw in user_message.lower() for kw in long_answer_keywords)
-        max_tokens = 1000 if is_long else 300
-
-        response = client.chat.completions.create(
-            model="mistralai/mistral-7b-instruct",
-            messages=user_chat_history[user_id],
-            max_tokens=max_tokens,
+        if on_delta is None:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+            )
+            usage = response.usage
+            bot_reply = response.choices[0].message.content.strip()
+        else:
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            parts = []
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    parts.append(chunk.choices[0].delta.content)
+                    await on_delta("".join(parts))
+            bot_reply = "".join(parts).strip()
+        outcome = "ok"
+        return bot_reply
+    except RateLimitError:
+        outcome = "rate_limited"
+        raise
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        UPSTREAM_SECONDS.observe(elapsed, model=model, outcome=outcome)
+        ttft = None
+        if first_token_at is not None:
+            ttft = first_token_at - started
+            UPSTREAM_TTFT_SECONDS.observe(ttft, model=model)
+        prompt_tokens = completion_tokens = None
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+            UPSTREAM_TOKENS.inc(prompt_tokens or 0, model=model, kind="prompt")
+            UPSTREAM_TOKENS.inc(completion_tokens or 0, model=model, kind="completion")
+        trace(
+            "upstream", model=model, outcome=outcome, stream=on_delta is not None,
+            ttft=ttft and round(ttft, 4), seconds=round(elapsed, 4),
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
         )
 
-        bot_reply = response.choices[0].message.content.strip()
-        user_chat_history[user_id].append({"role": "assistant", "content": bot_reply})
+# Запрос к модели без привязки к истории: через общую очередь, с повторами и запасными моделями.
+# Если ответ уже начал показываться пользователю, повторов не будет
+async def complete(messages: list, max_tokens: int, on_delta=None, model: str = None,
+                   priority: int = PRIORITY_CHAT) -> str:
+    models = [model] if model else MODELS
+    started = False
+
+    async def track_delta(text: str):
+        nonlocal started
+        started = True
+        await on_delta(text)
+
+    delay = RETRY_BASE_DELAY
+    for attempt in range(RETRY_ATTEMPTS):
+        wait = 0.0
+        for candidate in models:
+            try:
+                queued_at = time.perf_counter()
+                async with llm_limiter.slot(priority):
+                    QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued_at, priority=priority)
+                    return await _complete_once(messages, max_tokens, on_delta and track_delta, candidate)
+            except (RateLimitError, InternalServerError, APIConnectionError) as e:
+                if started:
+                    raise
+                error = e
+                wait = max(wait, retry_after(e) or 0.0)
+
+        if attempt + 1 == RETRY_ATTEMPTS or wait > RETRY_MAX_DELAY:
+            raise error
+        await asyncio.sleep(max(wait, random.uniform(0, delay)))
+        delay = min(delay * 2, RETRY_MAX_DELAY)
 
-        # Обрезаем историю до 20 сообщений
-        if len(user_chat_history[user_id]) > 20:
-            user_chat_history[user_id] = [SYSTEM_PROMPT.copy()] + user_chat_history[user_id][-18:]
+# Получение ответа от модели в диалоге с пользователем
+# extra_context — дополнительные системные сообщения, которые не сохраняются в истории
+# rate_key — чей лимит расходует запрос, если это не владелец истории (автор сообщения в группе)
+async def get_gpt_response(user_id: int, user_message: str, on_delta=None, extra_context=None, rate_key=None) -> str:
+    if not user_buckets.allow(user_id if rate_key is None else rate_key):
+        REJECTED.inc(reason="user_rate")
+        trace("rejected", reason="user_rate")
+        return SLOW_DOWN_REPLY
+    queued_at = time.perf_counter()
+    async with user_turn(user_id):
+        USER_WAIT_SECONDS.observe(time.perf_counter() - queued_at)
+        return await _get_gpt_response(user_id, user_message, on_delta, extra_context)
+
+async def _get_gpt_response(user_id: int, user_message: str, on_delta=None, extra_context=None) -> str:
+    try:
+        conversation = await history.load(user_id)
+        conversation.add("user", user_message)
+        try:
+            messages = [SYSTEM_PROMPT] + (extra_context or []) + conversation.context(HISTORY_TOKEN_BUDGET)
+            max_tokens = pick_max_tokens(user_message)
+            # Ответ на первую реплику не зависит от истории, его можно взять из кэша
+            if RESPONSE_CACHE and not extra_context and len(conversation.turns) == 1 and not conversation.summary:
+                bot_reply = await response_cache.get_or_create(
+                    prompt_key(messages, max_tokens, MODEL), lambda: complete(messages, max_tokens, on_delta)
+                )
+            else:
+                bot_reply = await complete(messages, max_tokens, on_delta)
+        except BaseException:
+            # Реплика без ответа не остаётся в истории: пользователь отправит её ещё раз
+            conversation.pop_latest()
+            raise
+        conversation.add("assistant", bot_reply)
+        history.save(user_id, conversation)
+
+        if conversation.total_tokens > HISTORY_TOKEN_BUDGET and user_id not in summary_tasks:
+            task = asyncio.create_task(summarize_history(user_id))
+            summary_tasks[user_id] = task
+            task.add_done_callback(lambda _: summary_tasks.pop(user_id, None))
 
         return bot_reply
+    except (Overloaded, RateLimitError) as e:
+        reason = "queue_full" if isinstance(e, Overloaded) else "upstream_429"
+        REJECTED.inc(reason=reason)
+        trace("rejected", reason=reason)
+        return BUSY_REPLY
+    except (InternalServerError, APIConnectionError) as e:
+        # Повторы и запасные модели не помогли. Подробности — в журнал, пользователю — понятный ответ
+        trace("upstream_failed", error=type(e).__name__)
+        print(f"Ошибка GPT: {e}")
+        return ERROR_REPLY
     except Exception as e:
-        return f"Ошибка GPT: {e}"
+        print(f"Ошибка GPT: {e}")
+        return ERROR_REPLY
+
+# Сворачивание старых реплик в краткое содержание. Запускается в фоне после ответа
+# и не задерживает следующее сообщение пользователя
+async def summarize_history(user_id: int):
+    # Под очередью пользователя только снимок истории и запись результата. Сам запрос к модели
+    # идёт без неё: иначе следующее сообщение ждало бы фоновый запрос с низшим приоритетом
+    async with user_turn(user_id):
+        conversation = await history.load(user_id)
+        count = conversation.fold_count(HISTORY_TOKEN_BUDGET // 2, HISTORY_KEEP_TURNS)
+        if not count:
+            return
+        turns = conversation.turns[:count]
+        previous_summary = conversation.summary
+
+    folded = "\n".join(f"{role}: {content}" for role, content, _ in turns)
+    if previous_summary:
+        folded = f"Прежнее краткое содержание: {previous_summary}\n\n{folded}"
+    try:
+        summary = await complete(
+            [SUMMARY_PROMPT, {"role": "user", "content": folded}], SUMMARY_MAX_TOKENS,
+            model=SUMMARY_MODEL, priority=PRIORITY_BACKGROUND,
+        )
+    except Exception as e:
+        print(f"Ошибка сворачивания истории: {e}")
+        summary = None
+
+    async with user_turn(user_id):
+        conversation = await history.load(user_id)
+        # Пока шёл запрос, начало истории могло измениться — тогда краткое содержание уже не про неё
+        if conversation.turns[:count] != turns or conversation.summary != previous_summary:
+            return
+        if summary is None:
+            # Без краткого содержания не даём истории расти бесконечно
+            if conversation.total_tokens > 2 * HISTORY_TOKEN_BUDGET:
+                conversation.pop_oldest(count)
+                history.save(user_id, conversation)
+            return
+        conversation.pop_oldest(count)
+        conversation.set_summary(summary)
+        history.save(user_id, conversation)
+
+# Ответ на inline-запрос: без истории, через кэш. Запрос отправляется только после паузы в наборе
+async def _debounced_inline_response(user_id: int, query: str) -> str:
+    messages = [SYSTEM_PROMPT, {"role": "user", "content": query}]
+    max_tokens = pick_max_tokens(query)
+    key = prompt_key(messages, max_tokens, MODEL)
+    if inline_cache.get(key) is None:
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if not user_buckets.allow(user_id):
+            REJECTED.inc(reason="user_rate")
+            raise RateLimited()
+    return await inline_cache.get_or_create(key, lambda: complete(messages, max_tokens, priority=PRIORITY_INLINE))
+
+# Индикатор "печатает..." гаснет через ~5 секунд, поэтому обновляем его в фоне до конца ответа
+async def keep_typing(bot, chat_id: int):
+    try:
+        while True:
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+            await asyncio.sleep(TYPING_INTERVAL)
+    except Exception as e:
+        print(f"Ошибка typing: {e}")
+
+# Постепенная отправка ответа: одно сообщение, которое редактируется по мере генерации.
+# Правки идут в фоновой задаче, поэтому запросы к Telegram не задерживают чтение потока
+# и не занимают слот в очереди к модели
+class StreamingReply:
+    def __init__(self, message):
+        self.message = message
+        self.interval = STREAM_EDIT_INTERVAL if message.chat.type == ChatType.PRIVATE else STREAM_GROUP_EDIT_INTERVAL
+        self.sent = None
+        self.shown = ""
+        self.pending = None
+        self.next_edit_at = 0.0
+        self._task = None
+        self._showing = False
+
+    async def update(self, text: str):
+        text = text.strip()[:MessageLimit.MAX_TEXT_LENGTH]
+        if not text or (self.sent is None and len(text) < STREAM_MIN_CHARS):
+            return
+        self.pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._pump())
+
+    # Показывает последний накопленный текст не чаще раза в interval секунд
+    async def _pump(self):
+        while self.pending and self.pending != self.shown:
+            delay = self.next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = self.pending
+            if not text:
+                return
+            self.next_edit_at = time.monotonic() + self.interval
+            self._showing = True
+            try:
+                await self._show(text)
+            finally:
+                self._showing = False
+
+    async def finish(self, text: str):
+        # Дожидаемся начатой правки, а ожидающую паузу просто отменяем
+        self.pending = None
+        if self._task is not None and not self._task.done():
+            if not self._showing:
+                self._task.cancel()
+            await asyncio.wait({self._task})
+
+        chunks = [text[i:i + MessageLimit.MAX_TEXT_LENGTH] for i in range(0, len(text), MessageLimit.MAX_TEXT_LENGTH)]
+        first, rest = (chunks[0], chunks[1:]) if chunks else ("…", [])
+        while True:
+            try:
+                await self._show(first, final=True)
+                break
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+        for chunk in rest:
+            await self.message.reply_text(chunk)
+
+    async def _show(self, text: str, final: bool = False):
+        try:
+            if self.sent is None:
+                self.sent = await self.message.reply_text(text)
+            elif text != self.shown:
+                await self.sent.edit_text(text)
+            self.shown = text
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                self.shown = text
+            elif final and self.sent is not None:
+                # Промежуточное сообщение не удалось отредактировать — отправляем ответ заново
+                self.sent = await self.message.reply_text(text)
+                self.shown = text
+            elif final:
+                raise
+            else:
+                print(f"Ошибка правки ответа: {e}")
+        except RetryAfter as e:
+            if final:
+                raise
+            # Telegram просит подождать — пропускаем промежуточные правки
+            self.next_edit_at = time.monotonic() + e.retry_after
+        except TelegramError as e:
+            if final:
+                raise
+            # Промежуточные правки не обязательны, полный текст отправит finish()
+            print(f"Ошибка правки ответа: {e}")
+
+# Ответ модели на сообщение: с индикатором набора и, если включено, потоком
+async def reply_with_gpt(update: Update, context: CallbackContext, user_id: int, user_message: str,
+                         extra_context=None, rate_key=None):
+    typing = asyncio.create_task(keep_typing(context.bot, update.effective_chat.id))
+    try:
+        if STREAM_REPLIES:
+            reply = StreamingReply(update.message)
+            bot_reply = await get_gpt_response(user_id, user_message, reply.update, extra_context, rate_key)
+            await reply.finish(bot_reply)
+        else:
+            bot_reply = await get_gpt_response(user_id, user_message, extra_context=extra_context, rate_key=rate_key)
+            await update.message.reply_text(bot_reply)
+        return bot_reply
+    finally:
+        typing.cancel()
 
 # Обработка обычных сообщений
+@instrumented("handle_messages")
 async def handle_messages(update: Update, context: CallbackContext):
     if not update.message or not update.message.text:
         return
 
     user_id = update.message.from_user.id
     user_message = update.message.text.strip()
+    await reply_with_gpt(update, context, user_id, user_message)
+
+# Упоминание бота без учёта регистра: Telegram не различает @AblGptBot и @ablgptbot
+def mention_re(username: str) -> re.Pattern:
+    return re.compile(rf"@{re.escape(username)}(?!\w)", re.IGNORECASE)
+
+# Слово-триггер ищется целым словом: «бот» не должен срабатывать на «работу»
+def trigger_re(words) -> re.Pattern:
+    if not words:
+        return None
+    return re.compile(r"(?<!\w)(?:" + "|".join(map(re.escape, words)) + r")(?!\w)", re.IGNORECASE)
+
+GROUP_TRIGGER_RE = trigger_re(GROUP_TRIGGER_WORDS)
 
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    await asyncio.sleep(1)
+# Адресовано ли сообщение в группе боту. Проверка без обращения к модели
+def is_addressed_to_bot(message, bot) -> bool:
+    reply_to = message.reply_to_message
+    if reply_to and reply_to.from_user and reply_to.from_user.id == bot.id:
+        return True
+    if mention_re(bot.username).search(message.text):
+        return True
+    return bool(GROUP_TRIGGER_RE and GROUP_TRIGGER_RE.search(message.text))
 
-    bot_reply = await asyncio.to_thread(get_gpt_response, user_id, user_message)
-    await update.message.reply_text(bot_reply)
+def remember_group_message(chat_id: int, line: str):
+    buffer = group_context.pop(chat_id, None) or deque(maxlen=GROUP_CONTEXT_MESSAGES)
+    buffer.append(line[:GROUP_CONTEXT_CHARS])
+    group_context[chat_id] = buffer
+    while len(group_context) > GROUP_CONTEXT_CHATS:
+        group_context.popitem(last=False)
 
-# Обработка упоминаний бота в группах
-async def mention_handler(update: Update, context: CallbackContext):
+# Убрать из буфера строки, которые модель уже видела. Пришедшие за время ответа остаются
+def forget_group_messages(chat_id: int, lines: list):
+    buffer = group_context.get(chat_id)
+    for line in lines:
+        if not buffer or buffer[0] is not line:
+            break
+        buffer.popleft()
+    if buffer is not None and not buffer:
+        del group_context[chat_id]
+
+# Обработка сообщений в группах. У группы один общий диалог с ботом (по chat_id)
+@instrumented("group_messages")
+async def group_messages(update: Update, context: CallbackContext):
     message = update.message
     if not message or not message.text:
         return
 
-    bot_username = context.bot.username
-    if f"@{bot_username}" in message.text:
-        await message.reply_text(f"Привет, {message.from_user.first_name}! Я AblGpt. Чем могу помочь?")
+    chat_id = update.effective_chat.id
+    author = message.from_user.first_name if message.from_user else "Аноним"
+    if not is_addressed_to_bot(message, context.bot):
+        remember_group_message(chat_id, f"{author}: {message.text}")
+        return
+
+    user_message = mention_re(context.bot.username).sub("", message.text).strip()
+    if not user_message:
+        await message.reply_text(f"Привет, {author}! Я AblGpt. Чем могу помочь?")
+        return
+
+    extra_context = None
+    recent = list(group_context.get(chat_id, ()))
+    if recent:
+        extra_context = [{
+            "role": "system",
+            "content": "Недавние сообщения в чате:\n" + "\n".join(recent)
+        }]
+    # История и очерёдность общие на чат, а лимит запросов — у каждого участника свой
+    rate_key = message.from_user.id if message.from_user else chat_id
+    bot_reply = await reply_with_gpt(update, context, chat_id, f"{author}: {user_message}", extra_context, rate_key)
+    # В следующий раз модель увидит только сообщения после этого обращения. При отказе буфер
+    # сохраняется, чтобы повторное обращение получило тот же контекст
+    if bot_reply not in REFUSAL_REPLIES:
+        forget_group_messages(chat_id, recent)
 
 # Обработка inline-запросов
+@instrumented("inline_query")
 async def inline_query(update: Update, context: CallbackContext):
     query = update.inline_query.query
     if not query:
         return
 
     user_id = update.inline_query.from_user.id
+
+    # Новый запрос отменяет ещё не завершённый предыдущий запрос того же пользователя
+    previous = inline_tasks.get(user_id)
+    if previous:
+        previous.cancel()
+    task = asyncio.create_task(_debounced_inline_response(user_id, query))
+    inline_tasks[user_id] = task
+    try:
+        await asyncio.wait({task})
+    finally:
+        if inline_tasks.get(user_id) is task:
+            del inline_tasks[user_id]
+    if task.cancelled():
+        raise Superseded()
+
     try:
-        gpt_response = await asyncio.to_thread(get_gpt_response, user_id, query)
+        gpt_response = task.result()
         result = [
             InlineQueryResultArticle(
                 id=str(uuid4()),
@@ -107,18 +618,74 @@ async def inline_query(update: Update, context: CallbackContext):
                 input_message_content=InputTextMessageContent(gpt_response)
             )
         ]
-        await update.inline_query.answer(result)
+        await update.inline_query.answer(result, cache_time=INLINE_CACHE_TTL)
+    except (Overloaded, RateLimited, RateLimitError):
+        # Под нагрузкой inline-запросы просто остаются без ответа
+        return
     except Exception as e:
         print(f"Ошибка inline: {e}")
 
-# Запуск бота
-def main():
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+# Состояние бота, которое отдаётся в /metrics как gauge
+metrics.Gauge("ablgpt_history_hot_users", "Диалоги в памяти", lambda: len(history))
+metrics.Gauge("ablgpt_history_pending_writes", "Диалоги, ожидающие записи на диск", lambda: history.pending)
+metrics.Gauge("ablgpt_llm_active", "Запросы к модели в работе", lambda: llm_limiter.active)
+metrics.Gauge("ablgpt_llm_queued", "Запросы в очереди к модели", lambda: llm_limiter.queued)
+metrics.Gauge("ablgpt_user_queues", "Пользователи с сообщениями в обработке", lambda: len(user_locks))
+metrics.Gauge("ablgpt_group_context_chats", "Группы с буфером контекста", lambda: len(group_context))
+CACHES = (("response", response_cache), ("inline", inline_cache))
+metrics.Gauge(
+    "ablgpt_cache_entries", "Записи в кэшах ответов", lambda: {(name,): len(cache) for name, cache in CACHES}, ("cache",)
+)
+metrics.CallbackCounter(
+    "ablgpt_cache_requests_total", "Обращения к кэшам ответов по результату",
+    lambda: {(name, result): cache.stats()[stat] for name, cache in CACHES
+             for result, stat in (("hit", "hits"), ("miss", "misses"), ("coalesced", "coalesced"))},
+    ("cache", "result"),
+)
+
+metrics_server = None
+
+# Запуск фоновой записи истории и сервера метрик
+async def on_startup(app: Application):
+    global metrics_server
+    history.start()
+    if METRICS_PORT:
+        metrics_server = metrics.make_app().listen(METRICS_PORT)
+
+# Сохранение истории и закрытие пула соединений при остановке
+async def on_shutdown(app: Application):
+    if metrics_server is not None:
+        metrics_server.stop()
+    await asyncio.gather(*summary_tasks.values(), return_exceptions=True)
+    await history.close()
+    await client.close()
+
+# Сборка приложения со всеми обработчиками. base_url позволяет направить запросы
+# к Bot API на локальную заглушку (см. bench/)
+def build_application(base_url: str = None) -> Application:
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .request(TimedRequest())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    app = builder.build()
 
     app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_messages))
-    app.add_handler(MessageHandler(filters.TEXT & filters.ChatType.GROUPS, mention_handler))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_messages))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS, group_messages))
     app.add_handler(InlineQueryHandler(inline_query))
+    return app
+
+# Запуск бота
+def main():
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    metrics.trace_log.setLevel(logging.INFO if TRACE_LOG else logging.WARNING)
+    app = build_application()
 
     print("Бот запущен...")
 
@@ -0,0 +1,83 @@
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+
+# LRU-кэш с ограничением по числу записей и времени жизни каждой записи.
+# get_or_create объединяет одновременные запросы одного ключа в одно вычисление
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    async def get_or_create(self, key, factory):
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        entry = self._pending.get(key)
+        if entry is None:
+            self.misses += 1
+            task = asyncio.ensure_future(factory())
+            entry = self._pending[key] = [task, 0]
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.coalesced += 1
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            # Последний ожидающий ушёл — общее вычисление больше никому не нужно.
+            # Запись убираем сразу, чтобы новый вызов не присоединился к отменённой задаче
+            if entry[1] == 0 and not task.done():
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+                task.cancel()
+
+    def _finish(self, key, task):
+        if self._pending.get(key, [None])[0] is task:
+            del self._pending[key]
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result())
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+# Нормализация текста запроса для ключа кэша: регистр и лишние пробелы не важны
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+# Ключ ответа модели: нормализованная последняя реплика плюс отпечаток всего, что ей предшествует
+def prompt_key(messages: list, max_tokens: int, model: str) -> tuple:
+    context = json.dumps([messages[:-1], max_tokens, model], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(context.encode()).hexdigest(), normalize_text(messages[-1]["content"])
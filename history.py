@@ -0,0 +1,208 @@
+import sys
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Холодное хранилище истории: SQLite в режиме WAL, одна строка на пользователя
+class SQLiteBackend:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "user_id INTEGER PRIMARY KEY, messages TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def load(self, user_id: int):
+        with self._lock:
+            row = self._conn.execute("SELECT messages FROM history WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_many(self, items: dict):
+        now = time.time()
+        rows = [(user_id, data, now) for user_id, data in items.items()]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO history (user_id, messages, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET messages = excluded.messages, updated_at = excluded.updated_at",
+                rows,
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# Грубая оценка числа токенов без токенизатора модели: ~3 символа на токен
+# плюс служебные токены роли
+def count_tokens(text: str) -> int:
+    return len(text) // 3 + 4
+
+# Диалог одного пользователя: краткое содержание старых реплик и последние реплики.
+# Реплики хранятся кортежами (role, content, tokens), число токенов считается один раз
+class Conversation:
+    __slots__ = ("summary", "summary_tokens", "turns", "tokens")
+
+    def __init__(self, summary: str = "", turns=()):
+        self.summary = ""
+        self.summary_tokens = 0
+        self.turns = []
+        self.tokens = 0
+        self.set_summary(summary)
+        for turn in turns:
+            self.add(*turn)
+
+    def add(self, role: str, content: str, tokens: int = None):
+        if tokens is None:
+            tokens = count_tokens(content)
+        self.turns.append((sys.intern(role), content, tokens))
+        self.tokens += tokens
+
+    def pop_oldest(self, count: int) -> list:
+        dropped = self.turns[:count]
+        del self.turns[:count]
+        self.tokens -= sum(turn[2] for turn in dropped)
+        return dropped
+
+    def pop_latest(self):
+        role, content, tokens = self.turns.pop()
+        self.tokens -= tokens
+        return role, content, tokens
+
+    def set_summary(self, summary: str):
+        self.summary = summary
+        self.summary_tokens = count_tokens(summary) if summary else 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.summary_tokens + self.tokens
+
+    # Сколько самых старых реплик свернуть, чтобы уложиться в target, оставив не меньше keep последних
+    def fold_count(self, target: int, keep: int) -> int:
+        total = self.total_tokens
+        count = 0
+        while len(self.turns) - count > keep and total > target:
+            total -= self.turns[count][2]
+            count += 1
+        return count
+
+    # Сообщения для модели: краткое содержание и самые новые реплики, влезающие в бюджет.
+    # Последняя реплика попадает в контекст всегда
+    def context(self, budget: int) -> list:
+        budget -= self.summary_tokens
+        start = len(self.turns)
+        while start > 0 and (start == len(self.turns) or budget >= self.turns[start - 1][2]):
+            start -= 1
+            budget -= self.turns[start][2]
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": f"Краткое содержание предыдущего разговора: {self.summary}"})
+        messages.extend({"role": role, "content": content} for role, content, _ in self.turns[start:])
+        return messages
+
+    def to_json(self) -> str:
+        return json.dumps({"summary": self.summary, "turns": self.turns}, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data: str):
+        data = json.loads(data)
+        return cls(data.get("summary", ""), data.get("turns", ()))
+
+# История диалогов: ограниченный горячий слой в памяти (LRU + вытеснение по простою)
+# поверх холодного слоя. Запись в холодный слой идёт пачками в фоне
+class HistoryStore:
+    def __init__(self, backend=None, max_users: int = 1000, idle_ttl: float = 1800, flush_interval: float = 2.0):
+        self.backend = backend
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self._hot = OrderedDict()
+        self._dirty = {}
+        # Пачка, которая сейчас пишется на диск: до конца записи её читают отсюда
+        self._inflight = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    def __len__(self):
+        return len(self._hot)
+
+    # Число пользователей, чья история ещё не записана в холодный слой
+    @property
+    def pending(self) -> int:
+        return len(self._dirty.keys() | self._inflight.keys())
+
+    # История пользователя; при промахе подгружается из холодного слоя
+    async def load(self, user_id: int) -> Conversation:
+        entry = self._hot.get(user_id)
+        if entry is not None:
+            entry[0] = time.monotonic()
+            self._hot.move_to_end(user_id)
+            return entry[1]
+
+        data = self._dirty.get(user_id)
+        if data is None:
+            data = self._inflight.get(user_id)
+        if data is None and self.backend is not None:
+            data = await asyncio.to_thread(self.backend.load, user_id)
+            # Пока шла загрузка, историю мог подгрузить другой вызов
+            if user_id in self._hot:
+                return await self.load(user_id)
+        conversation = Conversation.from_json(data) if data else Conversation()
+        self._hot[user_id] = [time.monotonic(), conversation]
+        self._evict()
+        return conversation
+
+    # Сохранить изменённую историю: в памяти сразу, на диск при следующем сбросе
+    def save(self, user_id: int, conversation: Conversation):
+        self._hot[user_id] = [time.monotonic(), conversation]
+        self._hot.move_to_end(user_id)
+        self._evict()
+        if self.backend is not None:
+            self._dirty[user_id] = conversation.to_json()
+
+    def _evict(self):
+        deadline = time.monotonic() - self.idle_ttl
+        while self._hot:
+            user_id, (last_access, _) = next(iter(self._hot.items()))
+            if len(self._hot) <= self.max_users and last_access >= deadline:
+                break
+            del self._hot[user_id]
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty or self.backend is None:
+                return
+            batch = self._inflight = self._dirty
+            self._dirty = {}
+            try:
+                await asyncio.to_thread(self.backend.save_many, batch)
+            except Exception as e:
+                # Не теряем изменения: вернём их в очередь, если их не перезаписали новые
+                for user_id, data in batch.items():
+                    self._dirty.setdefault(user_id, data)
+                print(f"Ошибка записи истории: {e}")
+            finally:
+                self._inflight = {}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self._evict()
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        if self.backend is not None:
+            self.backend.close()
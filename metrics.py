@@ -0,0 +1,173 @@
+import json
+import time
+import bisect
+import asyncio
+import logging
+import functools
+import contextvars
+import tornado.web
+from telegram.request import HTTPXRequest
+
+# Минимальные метрики в текстовом формате Prometheus, без внешних зависимостей
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+# Значения меток экранируются по спецификации текстового формата: \\, \" и \n
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+# Значение gauge читается в момент отдачи /metrics. callback возвращает число
+# или словарь {кортеж значений меток: число}
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, callback, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.callback = callback
+        _registry.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+# Счётчик, который ведёт сам объект (например, кэш), а не код метрик: читается так же, как gauge
+class CallbackCounter(Gauge):
+    type = "counter"
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _format_labels(self.labels + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Метрики горячего пути
+HANDLER_SECONDS = Histogram("ablgpt_handler_seconds", "Время обработки обновления", ("handler", "outcome"))
+UPSTREAM_SECONDS = Histogram("ablgpt_upstream_seconds", "Полное время запроса к модели", ("model", "outcome"))
+UPSTREAM_TTFT_SECONDS = Histogram("ablgpt_upstream_ttft_seconds", "Время до первого токена потокового ответа", ("model",))
+UPSTREAM_TOKENS = Counter("ablgpt_upstream_tokens_total", "Токены запросов к модели", ("model", "kind"))
+QUEUE_WAIT_SECONDS = Histogram("ablgpt_queue_wait_seconds", "Ожидание слота в очереди к модели", ("priority",))
+USER_WAIT_SECONDS = Histogram("ablgpt_user_wait_seconds", "Ожидание предыдущего сообщения пользователя")
+REJECTED = Counter("ablgpt_rejected_total", "Запросы, отклонённые под нагрузкой", ("reason",))
+TELEGRAM_SECONDS = Histogram("ablgpt_telegram_seconds", "Время запросов к Bot API", ("method",))
+
+# Трассировка: JSON-строка на событие с update_id текущего обновления
+update_id_var = contextvars.ContextVar("update_id", default=None)
+trace_log = logging.getLogger("ablgpt.trace")
+
+def trace(event: str, **fields):
+    if trace_log.isEnabledFor(logging.INFO):
+        record = {"ts": round(time.time(), 3), "update_id": update_id_var.get(), "event": event, **fields}
+        trace_log.info(json.dumps(record, ensure_ascii=False))
+
+# Обработчик стал не нужен, например inline-запрос заменён следующим нажатием.
+# Такие вызовы учитываются с outcome="superseded", чтобы не смешиваться с настоящими ответами
+class Superseded(Exception):
+    pass
+
+# Обёртка обработчика: время в HANDLER_SECONDS и события начала/конца в трассировке
+def instrumented(name: str):
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            token = update_id_var.set(update.update_id)
+            started = time.perf_counter()
+            outcome = "ok"
+            trace("handler_start", handler=name)
+            try:
+                return await handler(update, context)
+            except Superseded:
+                outcome = "superseded"
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                HANDLER_SECONDS.observe(elapsed, handler=name, outcome=outcome)
+                trace("handler_end", handler=name, outcome=outcome, seconds=round(elapsed, 4))
+                update_id_var.reset(token)
+        return wrapper
+    return decorator
+
+# Запросы к Bot API с замером времени по методам
+class TimedRequest(HTTPXRequest):
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            api_method = url.rsplit("/", 1)[-1]
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=api_method)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(render())
+
+def make_app() -> tornado.web.Application:
+    return tornado.web.Application([(r"/metrics", MetricsHandler)])
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Модули бота лежат в корне репозитория, без пакета: делаем их импортируемыми и для простого `pytest`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# bot.py читает настройки при импорте: в тестах без сети, диска и сервера метрик
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:TEST")
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+os.environ.setdefault("HISTORY_DB", "")
+os.environ.setdefault("METRICS_PORT", "0")
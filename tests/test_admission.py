@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from admission import PRIORITY_BACKGROUND, PRIORITY_CHAT, PRIORITY_INLINE, Overloaded, PriorityLimiter, TokenBuckets
+
+
+def test_token_bucket_allows_burst_then_refills(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("admission.time.monotonic", lambda: now[0])
+    buckets = TokenBuckets(rate=0.5, burst=2)
+    assert [buckets.allow(1) for _ in range(3)] == [True, True, False]
+    # У другого пользователя своя корзина
+    assert buckets.allow(2)
+    now[0] += 2
+    assert buckets.allow(1)
+    assert not buckets.allow(1)
+
+
+def test_token_buckets_are_bounded():
+    buckets = TokenBuckets(rate=1, burst=1, max_keys=2)
+    for key in (1, 2, 3):
+        buckets.allow(key)
+    assert list(buckets._buckets) == [2, 3]
+
+
+def test_released_slot_goes_to_highest_priority():
+    async def scenario():
+        limiter = PriorityLimiter(capacity=1, max_queue=10)
+        await limiter.acquire()
+        order = []
+
+        async def waiter(name, priority):
+            async with limiter.slot(priority):
+                order.append(name)
+
+        tasks = [
+            asyncio.create_task(waiter("background", PRIORITY_BACKGROUND)),
+            asyncio.create_task(waiter("inline", PRIORITY_INLINE)),
+            asyncio.create_task(waiter("chat", PRIORITY_CHAT)),
+        ]
+        await asyncio.sleep(0)
+        assert limiter.queued == 3
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return order, limiter.active
+
+    assert asyncio.run(scenario()) == (["chat", "inline", "background"], 0)
+
+
+def test_full_queue_raises_overloaded():
+    async def scenario():
+        limiter = PriorityLimiter(capacity=1, max_queue=1)
+        await limiter.acquire()
+        queued = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await limiter.acquire()
+        queued.cancel()
+        await asyncio.wait({queued})
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue_and_keeps_slots():
+    async def scenario():
+        limiter = PriorityLimiter(capacity=1, max_queue=10)
+        await limiter.acquire()
+        cancelled = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.wait({cancelled})
+        assert limiter.queued == 0
+        limiter.release()
+        # Слот не потерян: следующий запрос получает его сразу
+        await asyncio.wait_for(limiter.acquire(), 1)
+        return limiter.active
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_slot_handed_to_cancelled_waiter_is_passed_on():
+    async def scenario():
+        limiter = PriorityLimiter(capacity=1, max_queue=10)
+        await limiter.acquire()
+        first = asyncio.create_task(limiter.acquire())
+        second = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        # Слот отдан первому, но тот отменён раньше, чем успел проснуться
+        limiter.release()
+        first.cancel()
+        await asyncio.wait({first})
+        await asyncio.wait_for(second, 1)
+        return limiter.active, limiter.queued
+
+    assert asyncio.run(scenario()) == (1, 0)
@@ -0,0 +1,323 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import APIConnectionError, InternalServerError, RateLimitError
+from telegram.error import TimedOut
+
+import bot
+from history import Conversation, HistoryStore
+
+REQUEST = httpx.Request("POST", "http://upstream/v1/chat/completions")
+
+
+def rate_limited(retry_after=None) -> RateLimitError:
+    headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+    return RateLimitError("429", response=httpx.Response(429, headers=headers, request=REQUEST), body=None)
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    # Заглушка _complete_once: отвечает по очереди из script (исключение или текст), паузы не ждёт
+    calls = []
+    sleeps = []
+    script = []
+
+    async def complete_once(messages, max_tokens, on_delta, model):
+        calls.append(model)
+        result = script.pop(0)
+        if callable(result):
+            result = await result(on_delta)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay):
+        sleeps.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(bot, "_complete_once", complete_once)
+    monkeypatch.setattr(bot.asyncio, "sleep", sleep)
+    monkeypatch.setattr(bot, "MODELS", ["main", "fallback"])
+    monkeypatch.setattr(bot, "RETRY_ATTEMPTS", 3)
+    monkeypatch.setattr(bot, "RETRY_BASE_DELAY", 0.0)
+    monkeypatch.setattr(bot, "RETRY_MAX_DELAY", 10.0)
+    return script, calls, sleeps
+
+
+def test_rate_limited_model_falls_back(upstream):
+    script, calls, sleeps = upstream
+    script[:] = [rate_limited(), "ответ"]
+    assert asyncio.run(bot.complete([], 100)) == "ответ"
+    assert calls == ["main", "fallback"] and sleeps == []
+
+
+def test_retry_waits_at_least_retry_after(upstream):
+    script, calls, sleeps = upstream
+    script[:] = [rate_limited(2), rate_limited(1), "ответ"]
+    assert asyncio.run(bot.complete([], 100)) == "ответ"
+    assert calls == ["main", "fallback", "main"] and sleeps == [2.0]
+
+
+def test_gives_up_when_retry_after_exceeds_max_delay(upstream):
+    script, calls, sleeps = upstream
+    script[:] = [rate_limited(30), rate_limited(30)]
+    with pytest.raises(RateLimitError):
+        asyncio.run(bot.complete([], 100))
+    assert calls == ["main", "fallback"] and sleeps == []
+
+
+def test_gives_up_after_last_attempt(upstream):
+    script, calls, sleeps = upstream
+    script[:] = [InternalServerError("500", response=httpx.Response(500, request=REQUEST), body=None)] * 6
+    with pytest.raises(InternalServerError):
+        asyncio.run(bot.complete([], 100))
+    assert len(calls) == 6 and len(sleeps) == 2
+
+
+def test_no_retry_once_text_is_visible(upstream):
+    script, calls, sleeps = upstream
+    shown = []
+
+    async def breaks_midway(on_delta):
+        await on_delta("нача")
+        return APIConnectionError(request=REQUEST)
+
+    async def on_delta(text):
+        shown.append(text)
+
+    script[:] = [breaks_midway, "ответ"]
+    with pytest.raises(APIConnectionError):
+        asyncio.run(bot.complete([], 100, on_delta))
+    assert calls == ["main"] and shown == ["нача"]
+
+
+def test_upstream_failure_gets_friendly_reply(upstream, monkeypatch):
+    monkeypatch.setattr(bot, "history", HistoryStore())
+    script, calls, sleeps = upstream
+    script[:] = [APIConnectionError(request=REQUEST)] * 6
+    reply = asyncio.run(bot.get_gpt_response(1, "привет"))
+    assert reply == bot.ERROR_REPLY
+    assert asyncio.run(bot.history.load(1)).turns == []
+
+
+def long_conversation(turns: int = 8) -> Conversation:
+    conversation = Conversation()
+    for i in range(turns):
+        conversation.add("user" if i % 2 == 0 else "assistant", f"{i} " + "x" * 60)
+    return conversation
+
+
+def test_summary_call_does_not_block_the_user(monkeypatch):
+    monkeypatch.setattr(bot, "history", HistoryStore())
+    monkeypatch.setattr(bot, "HISTORY_TOKEN_BUDGET", 60)
+    monkeypatch.setattr(bot, "HISTORY_KEEP_TURNS", 2)
+    release = asyncio.Event()
+
+    async def slow_complete(messages, max_tokens, on_delta=None, model=None, priority=None):
+        await release.wait()
+        return "кратко"
+
+    monkeypatch.setattr(bot, "complete", slow_complete)
+
+    async def scenario():
+        bot.history.save(1, long_conversation())
+        task = asyncio.create_task(bot.summarize_history(1))
+        await asyncio.sleep(0.01)
+
+        async def next_message():
+            async with bot.user_turn(1):
+                pass
+
+        # Сообщение пользователя проходит, пока фоновый запрос ещё идёт
+        await asyncio.wait_for(next_message(), 1)
+        release.set()
+        await task
+        return await bot.history.load(1)
+
+    conversation = asyncio.run(scenario())
+    assert conversation.summary == "кратко"
+    assert len(conversation.turns) == 2
+
+
+def test_summary_is_dropped_if_history_changed_meanwhile(monkeypatch):
+    monkeypatch.setattr(bot, "history", HistoryStore())
+    monkeypatch.setattr(bot, "HISTORY_TOKEN_BUDGET", 60)
+    monkeypatch.setattr(bot, "HISTORY_KEEP_TURNS", 2)
+
+    async def complete(messages, max_tokens, on_delta=None, model=None, priority=None):
+        # Пока модель отвечает, история пользователя очищается
+        bot.history.save(1, Conversation())
+        return "кратко"
+
+    monkeypatch.setattr(bot, "complete", complete)
+
+    async def scenario():
+        bot.history.save(1, long_conversation())
+        await bot.summarize_history(1)
+        return await bot.history.load(1)
+
+    conversation = asyncio.run(scenario())
+    assert conversation.summary == ""
+    assert conversation.turns == []
+
+
+class FakeSent:
+    def __init__(self, owner):
+        self.owner = owner
+
+    async def edit_text(self, text):
+        self.owner.edits.append(text)
+        if self.owner.failing_edits:
+            self.owner.failing_edits -= 1
+            raise TimedOut()
+
+
+class FakeMessage:
+    def __init__(self, chat_type="private", failing_edits=0):
+        self.chat = SimpleNamespace(type=chat_type)
+        self.replies = []
+        self.edits = []
+        self.failing_edits = failing_edits
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+        return FakeSent(self)
+
+    @property
+    def visible(self):
+        return self.edits[-1] if self.edits else self.replies[-1]
+
+
+def stream(reply, text, delay=0.001):
+    async def scenario():
+        for i in range(bot.STREAM_MIN_CHARS, len(text) + 1):
+            await reply.update(text[:i])
+            await asyncio.sleep(delay)
+        await reply.finish(text)
+
+    asyncio.run(scenario())
+
+
+def test_streamed_edits_are_coalesced(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0.05)
+    message = FakeMessage()
+    text = "слово " * 40
+    stream(bot.StreamingReply(message), text)
+    assert len(message.replies) == 1
+    assert 1 <= len(message.edits) < (len(text) - bot.STREAM_MIN_CHARS) // 10
+    assert message.visible == text
+
+
+def test_group_replies_are_edited_less_often(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0.01)
+    monkeypatch.setattr(bot, "STREAM_GROUP_EDIT_INTERVAL", 10.0)
+    assert bot.StreamingReply(FakeMessage("supergroup")).interval == 10.0
+    assert bot.StreamingReply(FakeMessage("private")).interval == 0.01
+
+
+def test_failed_intermediate_edits_do_not_stop_the_stream(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0.01)
+    message = FakeMessage(failing_edits=3)
+    text = "слово " * 20
+    stream(bot.StreamingReply(message), text, delay=0.005)
+    assert len(message.edits) > 3
+    assert message.visible == text
+
+
+def test_finish_cancels_waiting_pump_and_shows_full_text(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 60)
+    message = FakeMessage()
+
+    async def scenario():
+        reply = bot.StreamingReply(message)
+        await reply.update("а" * bot.STREAM_MIN_CHARS)
+        await asyncio.sleep(0.01)
+        # Следующая правка ждёт интервала — finish() не должен её дожидаться
+        await reply.update("б" * bot.STREAM_MIN_CHARS)
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(reply.finish("полный ответ"), 1)
+        return reply._task
+
+    pump = asyncio.run(scenario())
+    assert pump.cancelled()
+    assert message.replies == ["а" * bot.STREAM_MIN_CHARS] and message.edits == ["полный ответ"]
+
+
+BOT = SimpleNamespace(id=42, username="AblGptBot")
+
+
+def group_message(text, reply_to=None):
+    return SimpleNamespace(text=text, reply_to_message=reply_to, from_user=SimpleNamespace(id=7, first_name="Аня"))
+
+
+@pytest.mark.parametrize("text, addressed", [
+    ("ищу работу", False),
+    ("эй, бот, помоги", True),
+    ("БОТ!", True),
+    ("@ablgptbot что нового?", True),
+    ("@AblGptBot", True),
+    ("@AblGptBot2 привет", False),
+    ("просто разговор", False),
+])
+def test_is_addressed_to_bot(monkeypatch, text, addressed):
+    monkeypatch.setattr(bot, "GROUP_TRIGGER_RE", bot.trigger_re(["бот"]))
+    assert bot.is_addressed_to_bot(group_message(text), BOT) is addressed
+
+
+def test_reply_to_bot_is_addressed(monkeypatch):
+    monkeypatch.setattr(bot, "GROUP_TRIGGER_RE", None)
+    assert bot.is_addressed_to_bot(group_message("а дальше?", SimpleNamespace(from_user=SimpleNamespace(id=42))), BOT)
+    assert not bot.is_addressed_to_bot(group_message("а дальше?", SimpleNamespace(from_user=SimpleNamespace(id=7))), BOT)
+
+
+def test_mention_is_stripped_case_insensitively():
+    assert bot.mention_re(BOT.username).sub("", "@ablgptbot  что нового?").strip() == "что нового?"
+
+
+def run_group_message(monkeypatch, text, bot_reply):
+    seen = {}
+
+    async def reply_with_gpt(update, context, user_id, user_message, extra_context=None, rate_key=None):
+        seen.update(user_id=user_id, user_message=user_message, extra_context=extra_context, rate_key=rate_key)
+        return bot_reply
+
+    async def reply_text(text):
+        seen["greeting"] = text
+
+    monkeypatch.setattr(bot, "reply_with_gpt", reply_with_gpt)
+    message = group_message(text)
+    message.reply_text = reply_text
+    update = SimpleNamespace(update_id=1, message=message, effective_chat=SimpleNamespace(id=-100))
+    asyncio.run(bot.group_messages(update, SimpleNamespace(bot=BOT)))
+    return seen
+
+
+def test_group_context_is_kept_when_request_is_refused(monkeypatch):
+    monkeypatch.setattr(bot, "group_context", bot.OrderedDict())
+    bot.remember_group_message(-100, "Петя: привет всем")
+    seen = run_group_message(monkeypatch, "@AblGptBot что скажешь?", bot.SLOW_DOWN_REPLY)
+    assert seen["user_id"] == -100 and seen["rate_key"] == 7
+    assert seen["user_message"] == "Аня: что скажешь?"
+    assert "Петя: привет всем" in seen["extra_context"][0]["content"]
+    assert list(bot.group_context[-100]) == ["Петя: привет всем"]
+
+    run_group_message(monkeypatch, "@AblGptBot что скажешь?", "ответ")
+    assert -100 not in bot.group_context
+
+
+def test_bare_mention_gets_greeting_without_model(monkeypatch):
+    seen = run_group_message(monkeypatch, "@ablgptbot", "ответ")
+    assert seen == {"greeting": "Привет, Аня! Я AblGpt. Чем могу помочь?"}
+
+
+def test_lines_arriving_during_reply_stay_buffered(monkeypatch):
+    monkeypatch.setattr(bot, "group_context", bot.OrderedDict())
+    bot.remember_group_message(-100, "Петя: раз")
+    recent = list(bot.group_context[-100])
+    bot.remember_group_message(-100, "Петя: два")
+    bot.forget_group_messages(-100, recent)
+    assert list(bot.group_context[-100]) == ["Петя: два"]
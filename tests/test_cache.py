@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from cache import TTLCache, normalize_text, prompt_key
+
+
+def test_lru_eviction_keeps_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_expired_entries_are_dropped(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+    now[0] += 6
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_prompt_key_normalizes_text_and_fingerprints_context():
+    system = {"role": "system", "content": "s"}
+    key = prompt_key([system, {"role": "user", "content": "  Привет  "}], 300, "m")
+    assert key == prompt_key([system, {"role": "user", "content": "привет"}], 300, "m")
+    assert key != prompt_key([system, {"role": "user", "content": "привет"}], 1000, "m")
+    assert key != prompt_key([{"role": "system", "content": "x"}, {"role": "user", "content": "привет"}], 300, "m")
+    assert normalize_text(" A\tb ") == "a b"
+
+
+def test_concurrent_calls_are_coalesced():
+    async def scenario():
+        cache = TTLCache(maxsize=10, ttl=60)
+        calls = 0
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(*(cache.get_or_create("k", factory) for _ in range(5)))
+        assert results == ["answer"] * 5
+        assert await cache.get_or_create("k", factory) == "answer"
+        return calls, cache.stats()
+
+    calls, stats = asyncio.run(scenario())
+    assert calls == 1
+    assert stats == {"size": 1, "hits": 1, "misses": 1, "coalesced": 4}
+
+
+def test_errors_are_not_cached():
+    async def scenario():
+        cache = TTLCache(maxsize=10, ttl=60)
+
+        async def failing():
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            await cache.get_or_create("k", failing)
+        assert cache.get("k") is None
+
+    asyncio.run(scenario())
+
+
+def test_last_waiter_leaving_cancels_shared_call():
+    async def scenario():
+        cache = TTLCache(maxsize=10, ttl=60)
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def factory():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.create_task(cache.get_or_create("k", factory))
+        await started.wait()
+        waiter.cancel()
+        await asyncio.wait({waiter})
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+    asyncio.run(scenario())
+
+
+def test_new_caller_after_cancellation_starts_fresh_call():
+    async def scenario():
+        cache = TTLCache(maxsize=10, ttl=60)
+        calls = 0
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05 if calls == 1 else 0)
+            return f"answer {calls}"
+
+        first = asyncio.create_task(cache.get_or_create("k", factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        # Отменённая задача ещё не завершилась, а новый вызов уже пришёл
+        await asyncio.sleep(0)
+        result = await cache.get_or_create("k", factory)
+        await asyncio.wait({first})
+        return result, calls
+
+    assert asyncio.run(scenario()) == ("answer 2", 2)
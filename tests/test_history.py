@@ -0,0 +1,176 @@
+import asyncio
+
+from history import Conversation, HistoryStore, SQLiteBackend
+
+
+class FailingBackend:
+    def __init__(self):
+        self.fail = True
+        self.saved = {}
+
+    def load(self, user_id):
+        return self.saved.get(user_id)
+
+    def save_many(self, items):
+        if self.fail:
+            raise OSError("disk full")
+        self.saved.update(items)
+
+    def close(self):
+        pass
+
+
+def test_hot_tier_is_bounded_and_lru():
+    async def scenario():
+        store = HistoryStore(max_users=2)
+        for user_id in (1, 2):
+            store.save(user_id, await store.load(user_id))
+        await store.load(1)
+        store.save(3, await store.load(3))
+        return list(store._hot)
+
+    assert asyncio.run(scenario()) == [1, 3]
+
+
+def test_idle_users_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("history.time.monotonic", lambda: now[0])
+
+    async def scenario():
+        store = HistoryStore(idle_ttl=60)
+        store.save(1, await store.load(1))
+        now[0] += 30
+        store.save(2, await store.load(2))
+        now[0] += 40
+        store._evict()
+        return list(store._hot)
+
+    assert asyncio.run(scenario()) == [2]
+
+
+def test_history_survives_restart_via_sqlite(tmp_path):
+    path = str(tmp_path / "history.db")
+
+    async def write():
+        store = HistoryStore(SQLiteBackend(path), max_users=1)
+        conversation = await store.load(1)
+        conversation.add("user", "привет")
+        conversation.add("assistant", "здравствуйте")
+        store.save(1, conversation)
+        # Пользователь вытеснен из памяти до сброса — история должна найтись среди ожидающих записи
+        store.save(2, await store.load(2))
+        assert len(store) == 1
+        assert (await store.load(1)).turns[0][1] == "привет"
+        assert store.pending == 2
+        await store.close()
+
+    async def read():
+        store = HistoryStore(SQLiteBackend(path))
+        conversation = await store.load(1)
+        await store.close()
+        return [(role, content) for role, content, _ in conversation.turns]
+
+    asyncio.run(write())
+    assert asyncio.run(read()) == [("user", "привет"), ("assistant", "здравствуйте")]
+
+
+def test_failed_flush_keeps_pending_writes():
+    async def scenario():
+        backend = FailingBackend()
+        store = HistoryStore(backend)
+        conversation = await store.load(1)
+        conversation.add("user", "раз")
+        store.save(1, conversation)
+        await store.flush()
+        assert store.pending == 1
+
+        backend.fail = False
+        await store.flush()
+        assert store.pending == 0
+        return Conversation.from_json(backend.saved[1]).turns[0][1]
+
+    assert asyncio.run(scenario()) == "раз"
+
+
+def test_conversation_tracks_tokens_incrementally():
+    conversation = Conversation()
+    conversation.add("user", "a" * 30)
+    conversation.add("assistant", "b" * 60)
+    assert conversation.tokens == (30 // 3 + 4) + (60 // 3 + 4)
+    conversation.set_summary("c" * 9)
+    assert conversation.total_tokens == conversation.tokens + 9 // 3 + 4
+    dropped = conversation.pop_oldest(1)
+    assert [content for _, content, _ in dropped] == ["a" * 30]
+    assert conversation.tokens == 60 // 3 + 4
+
+
+def test_context_keeps_newest_turns_within_budget():
+    conversation = Conversation(turns=[("user", "x" * 30, 10), ("assistant", "y" * 30, 10), ("user", "z" * 30, 10)])
+    assert [m["content"][0] for m in conversation.context(25)] == ["y", "z"]
+    # Последняя реплика попадает в контекст, даже если одна превышает бюджет
+    assert [m["content"][0] for m in conversation.context(1)] == ["z"]
+
+
+def test_context_puts_summary_first_and_counts_it():
+    conversation = Conversation("кратко", [("user", "a", 10), ("assistant", "b", 10)])
+    messages = conversation.context(conversation.summary_tokens + 10)
+    assert messages[0]["role"] == "system" and "кратко" in messages[0]["content"]
+    assert [m["content"] for m in messages[1:]] == ["b"]
+
+
+def test_fold_count_respects_target_and_keep():
+    conversation = Conversation(turns=[("user", str(i), 10) for i in range(6)])
+    assert conversation.fold_count(target=30, keep=2) == 3
+    assert conversation.fold_count(target=0, keep=4) == 2
+    assert conversation.fold_count(target=100, keep=0) == 0
+
+
+def test_json_roundtrip():
+    conversation = Conversation("s", [("user", "hi", 4)])
+    restored = Conversation.from_json(conversation.to_json())
+    assert restored.summary == "s" and restored.turns == [("user", "hi", 4)]
+
+
+def test_pop_latest_drops_unanswered_turn():
+    conversation = Conversation()
+    conversation.add("user", "a" * 30)
+    tokens = conversation.tokens
+    conversation.add("user", "повтор")
+    assert conversation.pop_latest()[1] == "повтор"
+    assert conversation.tokens == tokens
+    assert [content for _, content, _ in conversation.turns] == ["a" * 30]
+
+
+def test_load_during_flush_sees_batch_being_written():
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        backend = FailingBackend()
+        writing = asyncio.Event()
+        release = asyncio.Event()
+        save_many = backend.save_many
+
+        def slow_save_many(items):
+            loop.call_soon_threadsafe(writing.set)
+            asyncio.run_coroutine_threadsafe(release.wait(), loop).result()
+            save_many(items)
+
+        backend.save_many = slow_save_many
+        store = HistoryStore(backend, max_users=1)
+        conversation = await store.load(1)
+        conversation.add("user", "turn1")
+        store.save(1, conversation)
+        store.save(2, await store.load(2))
+
+        flush = asyncio.create_task(store.flush())
+        await writing.wait()
+        # Пользователь 1 вытеснен, а его история ещё пишется (и запись не удастся)
+        conversation = await store.load(1)
+        conversation.add("user", "turn2")
+        store.save(1, conversation)
+        release.set()
+        await flush
+        backend.fail = False
+        await store.flush()
+        return [content for _, content, _ in Conversation.from_json(backend.saved[1]).turns]
+
+    assert asyncio.run(scenario()) == ["turn1", "turn2"]
@@ -0,0 +1,49 @@
+import asyncio
+from types import SimpleNamespace
+
+from metrics import (
+    HANDLER_SECONDS, CallbackCounter, Counter, Gauge, Histogram, Superseded, _format_labels, instrumented
+)
+
+
+def test_label_values_are_escaped():
+    assert _format_labels(("q",), ('a\\b "c"\nd',)) == '{q="a\\\\b \\"c\\"\\nd"}'
+    assert _format_labels((), ()) == ""
+
+
+def test_callback_counter_renders_as_counter():
+    counter = CallbackCounter("test_requests_total", "h", lambda: {("x", "hit"): 3}, ("cache", "result"))
+    gauge = Gauge("test_entries", "h", lambda: 5)
+    assert counter.render()[1:] == ["# TYPE test_requests_total counter", 'test_requests_total{cache="x",result="hit"} 3']
+    assert gauge.render()[1:] == ["# TYPE test_entries gauge", "test_entries 5"]
+
+
+def test_counter_accumulates_per_label_set():
+    counter = Counter("test_total", "h", ("reason",))
+    counter.inc(reason="a")
+    counter.inc(2, reason="a")
+    counter.inc(reason="b")
+    assert counter.render()[2:] == ['test_total{reason="a"} 3', 'test_total{reason="b"} 1']
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_seconds", "h", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        "test_seconds_sum 5.55",
+        "test_seconds_count 3",
+    ]
+
+
+def test_superseded_handler_is_recorded_separately():
+    @instrumented("test_handler")
+    async def handler(update, context):
+        raise Superseded()
+
+    assert asyncio.run(handler(SimpleNamespace(update_id=1), None)) is None
+    assert sum(HANDLER_SECONDS._series[("test_handler", "superseded")][0]) == 1
+    assert ("test_handler", "ok") not in HANDLER_SECONDS._series